@@ -15,43 +15,234 @@
 
 """Defines model architectures."""
 
+import contextlib
 import functools
+import operator
 
-import numpy as np
 import tensorflow.compat.v1 as tf
 
 from poem.core import common
 from poem.core import data_utils
 
 
-def _linear(input_features, output_size, weight_max_norm, weight_initializer,
-            bias_initializer, name):
-  """Builds a linear layer.
+@contextlib.contextmanager
+def _maybe_jit_scope(use_xla_jit):
+  """Opens an XLA JIT compilation scope if enabled.
+
+  Args:
+    use_xla_jit: A boolean for whether to compile ops created in the scope with
+      XLA.
+
+  Yields:
+    None.
+  """
+  if use_xla_jit:
+    with tf.xla.experimental.jit_scope():
+      yield
+  else:
+    yield
+
+
+def _get_shape(x):
+  """Gets tensor shape with static dimensions where known.
+
+  Args:
+    x: A tensor.
+
+  Returns:
+    A list of integers for static dimensions and scalar tensors for dynamic
+    dimensions.
+  """
+  dynamic_shape = tf.shape(x)
+  return [
+      dynamic_shape[i] if d is None else d
+      for i, d in enumerate(x.shape.as_list())
+  ]
+
+
+# Batch normalization epsilon shared by the training layer and the folded
+# inference parameters.
+_BATCH_NORM_EPSILON = 1e-3
+
+
+def _get_linear_variables(input_features, output_size, weight_max_norm,
+                          weight_initializer, bias_initializer, name):
+  """Gets linear layer variables.
 
   Args:
     input_features: A tensor for input features. Shape = [..., feature_dim].
     output_size: An integer for the number of output nodes.
-    weight_max_norm: A float for the maximum weight norm to clip at. Use
-      non-positive to ignore.
+    weight_max_norm: A float for the maximum weight norm to clip initial
+      weights and weights after each optimizer update at. Use non-positive to
+      ignore. Weights are not clipped when read, so checkpoints storing weights
+      above the maximum norm (e.g., trained when clipping was applied on read)
+      are used unclipped unless exported with
+      `pipeline_utils.export_embedder_saved_model`.
     weight_initializer: A function handle for kernel weight initializer.
     bias_initializer: A function handle for bias initializer.
     name: A string for the name scope.
 
   Returns:
-    A tensor for the output logits.
+    weights: A tensor for the kernel weights. Shape = [feature_dim,
+      output_size].
+    bias: A tensor for the bias. Shape = [output_size].
   """
+  weight_constraint = None
+  if weight_max_norm > 0.0:
+    # Clips weights at initialization and after each optimizer update rather
+    # than on every read.
+    weight_constraint = functools.partial(
+        tf.clip_by_norm, clip_norm=weight_max_norm)
+
+  def clipped_weight_initializer(shape, dtype=None, partition_info=None):
+    """Initializes weights within the maximum norm."""
+    weights = weight_initializer(
+        shape, dtype=dtype, partition_info=partition_info)
+    if weight_constraint is not None:
+      weights = weight_constraint(weights)
+    return weights
+
   with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
     weights = tf.get_variable(
         name='weight',
         shape=[input_features.shape.as_list()[-1], output_size],
-        initializer=weight_initializer)
-    if weight_max_norm > 0.0:
-      weights = tf.clip_by_norm(weights, clip_norm=weight_max_norm)
+        initializer=clipped_weight_initializer,
+        constraint=weight_constraint)
 
     bias = tf.get_variable(
         name='bias', shape=[output_size], initializer=bias_initializer)
 
-  return tf.linalg.matmul(input_features, weights) + bias
+  return weights, bias
+
+
+def _matmul(input_features, weights, compute_dtype):
+  """Multiplies input features by weights in a compute data type.
+
+  Args:
+    input_features: A float32 tensor for input features. Shape = [...,
+      feature_dim].
+    weights: A float32 tensor for the kernel weights. Shape = [feature_dim,
+      output_size].
+    compute_dtype: A data type for the multiplication, e.g., tf.bfloat16 or
+      tf.float16 for mixed precision. Inputs are cast to it.
+
+  Returns:
+    A float32 tensor for the product. Shape = [..., output_size].
+  """
+  if compute_dtype == tf.float32:
+    return tf.linalg.matmul(input_features, weights)
+  net = tf.linalg.matmul(
+      tf.cast(input_features, compute_dtype), tf.cast(weights, compute_dtype))
+  return tf.cast(net, tf.float32)
+
+
+def _linear(input_features,
+            output_size,
+            weight_max_norm,
+            weight_initializer,
+            bias_initializer,
+            name,
+            activation_fn=None,
+            compute_dtype=tf.float32):
+  """Builds a linear layer.
+
+  Args:
+    input_features: A tensor for input features. Shape = [..., feature_dim].
+    output_size: An integer for the number of output nodes.
+    weight_max_norm: A float for the maximum weight norm to clip initial
+      weights and weights after each optimizer update at. Use non-positive to
+      ignore.
+    weight_initializer: A function handle for kernel weight initializer.
+    bias_initializer: A function handle for bias initializer.
+    name: A string for the name scope.
+    activation_fn: A function handle for the activation applied directly after
+      the bias addition, so that matmul, bias addition and activation can be
+      fused. Use None to output logits.
+    compute_dtype: A data type for the matrix multiplication. Weights are
+      stored and bias addition is performed in float32.
+
+  Returns:
+    A tensor for the output logits or activations.
+  """
+  weights, bias = _get_linear_variables(
+      input_features,
+      output_size=output_size,
+      weight_max_norm=weight_max_norm,
+      weight_initializer=weight_initializer,
+      bias_initializer=bias_initializer,
+      name=name)
+  net = tf.nn.bias_add(
+      _matmul(input_features, weights, compute_dtype=compute_dtype), bias)
+  if activation_fn is not None:
+    net = activation_fn(net)
+  return net
+
+
+def _linear_with_folded_batch_norm(input_features, output_size,
+                                   weight_max_norm, weight_initializer,
+                                   bias_initializer, name, batch_norm_name,
+                                   activation_fn=None,
+                                   compute_dtype=tf.float32):
+  """Builds a linear layer followed by inference batch normalization.
+
+  At inference time, batch normalization is an affine transform using its
+  moving statistics, so it is folded into the linear layer weights and bias:
+    scale = gamma / sqrt(moving_variance + epsilon),
+    weights' = weights * scale,
+    bias' = (bias - moving_mean) * scale + beta.
+
+  The variables are shared with the `tf.layers.batch_normalization` layer of
+  the same name used in training.
+
+  Args:
+    input_features: A tensor for input features. Shape = [..., feature_dim].
+    output_size: An integer for the number of output nodes.
+    weight_max_norm: A float for the maximum weight norm to clip initial
+      weights and weights after each optimizer update at. Use non-positive to
+      ignore.
+    weight_initializer: A function handle for kernel weight initializer.
+    bias_initializer: A function handle for bias initializer.
+    name: A string for the linear layer name scope.
+    batch_norm_name: A string for the batch normalization layer name scope.
+    activation_fn: A function handle for the activation applied directly after
+      the bias addition. Use None to output normalized logits.
+    compute_dtype: A data type for the matrix multiplication. Weights are
+      stored, and folding and bias addition are performed in float32.
+
+  Returns:
+    A tensor for the normalized output logits or activations.
+  """
+  weights, bias = _get_linear_variables(
+      input_features,
+      output_size=output_size,
+      weight_max_norm=weight_max_norm,
+      weight_initializer=weight_initializer,
+      bias_initializer=bias_initializer,
+      name=name)
+
+  with tf.variable_scope(batch_norm_name, reuse=tf.AUTO_REUSE):
+    gamma = tf.get_variable(
+        name='gamma', shape=[output_size], initializer=tf.initializers.ones())
+    beta = tf.get_variable(
+        name='beta', shape=[output_size], initializer=tf.initializers.zeros())
+    moving_mean = tf.get_variable(
+        name='moving_mean',
+        shape=[output_size],
+        initializer=tf.initializers.zeros(),
+        trainable=False)
+    moving_variance = tf.get_variable(
+        name='moving_variance',
+        shape=[output_size],
+        initializer=tf.initializers.ones(),
+        trainable=False)
+
+  scale = gamma * tf.math.rsqrt(moving_variance + _BATCH_NORM_EPSILON)
+  net = tf.nn.bias_add(
+      _matmul(input_features, weights * scale, compute_dtype=compute_dtype),
+      (bias - moving_mean) * scale + beta)
+  if activation_fn is not None:
+    net = activation_fn(net)
+  return net
 
 
 def simple_base(input_features, is_training, name='SimpleModel', **kwargs):
@@ -71,32 +262,62 @@ def simple_base(input_features, is_training, name='SimpleModel', **kwargs):
     **kwargs: A dictionary for additional arguments. Supported arguments include
       `num_hidden_nodes`, `weight_initializer`, `bias_initializer`,
       `weight_max_norm`, `use_batch_norm`, `dropout_rate`, `num_fcs_per_block`,
-      and `num_fc_blocks`.
+      `num_fc_blocks`, `activation_fn`, `use_xla_jit`, and `compute_dtype`.
+      `activation_fn` defaults to ReLU. If `use_xla_jit` is True, the layers
+      are compiled with XLA so that the elementwise ops following each matmul
+      can be fused. If `compute_dtype` is tf.bfloat16 or tf.float16, the layer
+      matrix multiplications run in mixed precision, while variables, batch
+      normalization and activations stay in float32.
 
   Returns:
     A tensor for output activations. Shape = [..., output_dim].
   """
 
+  weight_initializer = kwargs.get('weight_initializer',
+                                  tf.initializers.he_normal())
+  bias_initializer = kwargs.get('bias_initializer', tf.initializers.he_normal())
+  activation_fn = kwargs.get('activation_fn', tf.nn.relu)
+
   def fully_connected(input_features, is_training, name):
     """Builds a fully connected layer."""
-    net = _linear(
-        input_features,
+    linear_kwargs = dict(
         output_size=kwargs.get('num_hidden_nodes', 1024),
         weight_max_norm=kwargs.get('weight_max_norm', 0.0),
-        weight_initializer=kwargs.get('weight_initializer',
-                                      tf.initializers.he_normal()),
-        bias_initializer=kwargs.get('bias_initializer',
-                                    tf.initializers.he_normal()),
-        name=name + '/Linear')
-
-    if kwargs.get('use_batch_norm', True):
+        weight_initializer=weight_initializer,
+        bias_initializer=bias_initializer,
+        name=name + '/Linear',
+        compute_dtype=kwargs.get('compute_dtype', tf.float32))
+
+    def activation(net):
+      """Applies the activation function."""
+      with tf.name_scope(name + '/Activation'):
+        return activation_fn(net)
+
+    if not kwargs.get('use_batch_norm', True):
+      net = _linear(
+          input_features, activation_fn=activation, **linear_kwargs)
+    elif is_training:
+      net = _linear(input_features, **linear_kwargs)
+      # Fused batch normalization only supports rank-4 inputs. Note that unlike
+      # the unfused implementation, it updates `moving_variance` with the
+      # unbiased (Bessel-corrected) batch variance, which is then used by the
+      # folded batch normalization at inference time.
+      net_shape = _get_shape(net)
       net = tf.layers.batch_normalization(
-          net,
+          tf.reshape(net, [-1, 1, 1, net_shape[-1]]),
+          epsilon=_BATCH_NORM_EPSILON,
           training=is_training,
+          fused=True,
           name=name + '/BatchNorm',
           reuse=tf.AUTO_REUSE)
-
-    net = tf.nn.relu(net, name=name + '/Relu')
+      net = tf.reshape(net, net_shape)
+      net = activation(net)
+    else:
+      net = _linear_with_folded_batch_norm(
+          input_features,
+          batch_norm_name=name + '/BatchNorm',
+          activation_fn=activation,
+          **linear_kwargs)
 
     dropout_rate = kwargs.get('dropout_rate', 0.0)
     if is_training and dropout_rate > 0.0:
@@ -112,11 +333,12 @@ def simple_base(input_features, is_training, name='SimpleModel', **kwargs):
     net += input_features
     return net
 
-  net = fully_connected(
-      input_features, is_training=is_training, name=name + '/InputFC')
-  for i in range(kwargs.get('num_fc_blocks', 2)):
-    net = fully_connected_block(
-        net, is_training, name=name + '/FullyConnectedBlock_%d' % i)
+  with _maybe_jit_scope(kwargs.get('use_xla_jit', False)):
+    net = fully_connected(
+        input_features, is_training=is_training, name=name + '/InputFC')
+    for i in range(kwargs.get('num_fc_blocks', 2)):
+      net = fully_connected_block(
+          net, is_training, name=name + '/FullyConnectedBlock_%d' % i)
   return net
 
 
@@ -149,8 +371,17 @@ def simple_model(input_features,
       model activations. Keys include 'base_activations' and optionally
       'bottleneck_activations'.
   """
+  weight_initializer = kwargs.pop('weight_initializer',
+                                  tf.initializers.he_normal())
+  bias_initializer = kwargs.pop('bias_initializer', tf.initializers.he_normal())
+
   net = simple_base(
-      input_features, is_training=is_training, name=name, **kwargs)
+      input_features,
+      is_training=is_training,
+      name=name,
+      weight_initializer=weight_initializer,
+      bias_initializer=bias_initializer,
+      **kwargs)
   activations = {'base_activations': net}
 
   if num_bottleneck_nodes > 0:
@@ -158,10 +389,8 @@ def simple_model(input_features,
         net,
         output_size=num_bottleneck_nodes,
         weight_max_norm=kwargs.get('weight_max_norm', 0.0),
-        weight_initializer=kwargs.get('weight_initializer',
-                                      tf.initializers.he_normal()),
-        bias_initializer=kwargs.get('bias_initializer',
-                                    tf.initializers.he_normal()),
+        weight_initializer=weight_initializer,
+        bias_initializer=bias_initializer,
         name=name + '/BottleneckLogits')
     activations['bottleneck_activations'] = net
 
@@ -171,24 +400,18 @@ def simple_model(input_features,
       output_size = [output_size]
     outputs[output_name] = _linear(
         net,
-        output_size=np.prod(output_size),
+        output_size=functools.reduce(operator.mul, output_size, 1),
         weight_max_norm=kwargs.get('weight_max_norm', 0.0),
-        weight_initializer=kwargs.get('weight_initializer',
-                                      tf.initializers.he_normal()),
-        bias_initializer=kwargs.get('bias_initializer',
-                                    tf.initializers.he_normal()),
+        weight_initializer=weight_initializer,
+        bias_initializer=bias_initializer,
         name=name + '/OutputLogits/' + output_name)
     if len(output_size) > 1:
-      outputs[output_name] = data_utils.recursively_expand_dims(
-          outputs[output_name], axes=[-1] * (len(output_size) - 1))
-      outputs[output_name] = data_utils.reshape_by_last_dims(
-          outputs[output_name], last_dim_shape=output_size)
+      outputs[output_name] = tf.reshape(
+          outputs[output_name],
+          _get_shape(outputs[output_name])[:-1] + list(output_size))
   return outputs, activations
 
 
-_add_prefix = lambda key, c: 'C%d/' % c + key
-
-
 def simple_point_embedder(input_features, num_embedding_components,
                           embedding_size, is_training, **kwargs):
   """Implements a point embedder based on `simple model`.
@@ -196,6 +419,11 @@ def simple_point_embedder(input_features, num_embedding_components,
   Output tensor shapes:
     KEY_EMBEDDING_MEANS: Shape = [..., num_embedding_components, embedding_dim].
 
+  All components share one output layer, with variables named
+  `OutputLogits/${KEY}`. Checkpoints with legacy per-component output layers
+  (`OutputLogits/C${c}/${KEY}`) need to be converted with
+  `pipeline_utils.convert_legacy_embedder_checkpoint`.
+
   Args:
     input_features: A tensor for input features. Shape = [..., feature_dim].
     num_embedding_components: An integer for the number of embedding components.
@@ -210,21 +438,10 @@ def simple_point_embedder(input_features, num_embedding_components,
       'bottleneck_activations'.
   """
   output_sizes = {
-      _add_prefix(common.KEY_EMBEDDING_MEANS, c): embedding_size
-      for c in range(num_embedding_components)
+      common.KEY_EMBEDDING_MEANS: [num_embedding_components, embedding_size],
   }
-
-  component_outputs, activations = simple_model(
+  outputs, activations = simple_model(
       input_features, output_sizes, is_training=is_training, **kwargs)
-
-  outputs = {
-      common.KEY_EMBEDDING_MEANS:
-          tf.stack([
-              component_outputs[_add_prefix(common.KEY_EMBEDDING_MEANS, c)]
-              for c in range(num_embedding_components)
-          ],
-                   axis=-2)
-  }
   return outputs, activations
 
 
@@ -245,6 +462,12 @@ def simple_gaussian_embedder(input_features,
     KEY_EMBEDDING_SAMPLES: Shape = [..., num_embedding_components, num_samples,
       embedding_dim].
 
+  Means and standard deviations of all components share one output layer, with
+  variables named `OutputLogits/gaussian_parameters`. Checkpoints with legacy
+  separate (`OutputLogits/${KEY}`) or per-component
+  (`OutputLogits/C${c}/${KEY}`) output layers need to be converted with
+  `pipeline_utils.convert_legacy_embedder_checkpoint`.
+
   Args:
     input_features: A tensor for input features. Shape = [..., feature_dim].
     num_embedding_components: An integer for the number of Gaussian mixture
@@ -262,54 +485,31 @@ def simple_gaussian_embedder(input_features,
       model activations. Keys include 'base_activations' and optionally
       'bottleneck_activations'.
   """
-  output_sizes = {}
-  for c in range(num_embedding_components):
-    output_sizes.update({
-        _add_prefix(common.KEY_EMBEDDING_MEANS, c): embedding_size,
-        _add_prefix(common.KEY_EMBEDDING_STDDEVS, c): embedding_size,
-    })
-  component_outputs, activations = simple_model(
+  # Means and standard deviations are computed by one output layer.
+  output_sizes = {
+      'gaussian_parameters': [2, num_embedding_components, embedding_size],
+  }
+  parameter_outputs, activations = simple_model(
       input_features, output_sizes, is_training=is_training, **kwargs)
-
-  for c in range(num_embedding_components):
-    component_outputs[_add_prefix(common.KEY_EMBEDDING_STDDEVS, c)] = (
-        tf.nn.elu(component_outputs[_add_prefix(common.KEY_EMBEDDING_STDDEVS,
-                                                c)]) + 1.0)
-
-    if num_embedding_samples > 0:
-      component_outputs[_add_prefix(common.KEY_EMBEDDING_SAMPLES, c)] = (
-          data_utils.sample_gaussians(
-              means=component_outputs[_add_prefix(common.KEY_EMBEDDING_MEANS,
-                                                  c)],
-              stddevs=component_outputs[_add_prefix(
-                  common.KEY_EMBEDDING_STDDEVS, c)],
-              num_samples=num_embedding_samples,
-              seed=seed))
+  means, stddevs = tf.unstack(
+      parameter_outputs['gaussian_parameters'], num=2, axis=-3)
 
   outputs = {
-      common.KEY_EMBEDDING_MEANS:
-          tf.stack([
-              component_outputs[_add_prefix(common.KEY_EMBEDDING_MEANS, c)]
-              for c in range(num_embedding_components)
-          ],
-                   axis=-2),
-      common.KEY_EMBEDDING_STDDEVS:
-          tf.stack([
-              component_outputs[_add_prefix(common.KEY_EMBEDDING_STDDEVS, c)]
-              for c in range(num_embedding_components)
-          ],
-                   axis=-2),
+      common.KEY_EMBEDDING_MEANS: means,
+      common.KEY_EMBEDDING_STDDEVS: tf.nn.elu(stddevs) + 1.0,
   }
+
   if num_embedding_samples > 0:
-    outputs[common.KEY_EMBEDDING_SAMPLES] = tf.stack([
-        component_outputs[_add_prefix(common.KEY_EMBEDDING_SAMPLES, c)]
-        for c in range(num_embedding_components)
-    ],
-                                                     axis=-3)
+    outputs[common.KEY_EMBEDDING_SAMPLES] = data_utils.sample_gaussians(
+        means=outputs[common.KEY_EMBEDDING_MEANS],
+        stddevs=outputs[common.KEY_EMBEDDING_STDDEVS],
+        num_samples=num_embedding_samples,
+        seed=seed)
 
   return outputs, activations
 
 
+@functools.lru_cache(maxsize=None)
 def create_embedder(embedding_type, num_embedding_components, embedding_size):
   """Creates an embedding model builder function handle.
 
@@ -320,7 +520,8 @@ def create_embedder(embedding_type, num_embedding_components, embedding_size):
     embedding_size: An integer for embedding dimensionality.
 
   Returns:
-    A function handle for embedding model builder.
+    A function handle for embedding model builder. Handles are cached by
+    arguments.
 
   Raises:
     ValueError: If embedding type is not supported.
@@ -339,10 +540,37 @@ def create_embedder(embedding_type, num_embedding_components, embedding_size):
   raise ValueError('Unsupported embedding type: `%s`.' % str(embedding_type))
 
 
+def enable_xla_autoclustering(session_config=None):
+  """Enables XLA auto-clustering in a session config.
+
+  Unlike `use_xla_jit`, this requires no changes to model building. TensorFlow
+  automatically clusters compilable ops (e.g., matmul, bias addition, batch
+  normalization and activation sequences) and compiles them with XLA. Input
+  shapes should be fixed (e.g., with a static batch size), otherwise clusters
+  are recompiled for each new shape.
+
+  Args:
+    session_config: A `tf.ConfigProto` to update. Use None to create a new one.
+
+  Returns:
+    The updated session config.
+  """
+  if session_config is None:
+    session_config = tf.ConfigProto()
+  session_config.graph_options.optimizer_options.global_jit_level = (
+      tf.OptimizerOptions.ON_2)
+  return session_config
+
+
 def embed(input_features, embedding_type, num_embedding_components,
           embedding_size, **kwargs):
   """An embedder wrapper with input/output transformation handling.
 
+  Rank-3 inputs are embedded with one embedder call for all instances. In
+  training mode, batch normalization statistics are therefore computed over
+  both the batch and instance dimensions, and moving statistics are updated
+  once per step (rather than separately for each instance).
+
   Args:
     input_features: A tensor for input features. Shape = [batch_size,
       feature_dim] or [batch_size, num_instances, feature_dim].
@@ -350,7 +578,8 @@ def embed(input_features, embedding_type, num_embedding_components,
       types in the `common` module.
     num_embedding_components: An integer for the number of embedding components.
     embedding_size: An integer for embedding dimensionality.
-    **kwargs: A dictionary for additional arguments for embedder.
+    **kwargs: A dictionary for additional arguments for embedder. If
+      `use_xla_jit` is True, the whole embedder is compiled with XLA.
 
   Returns:
     outputs: A dictionary for output tensors See comment above for details.
@@ -366,24 +595,9 @@ def embed(input_features, embedding_type, num_embedding_components,
   embedder_fn = create_embedder(embedding_type, num_embedding_components,
                                 embedding_size)
 
-  if input_features_rank == 2:
+  # Compiles the whole embedder in a single XLA scope (rather than only the
+  # model base) so that buffers can be reused across all layers.
+  with _maybe_jit_scope(kwargs.pop('use_xla_jit', False)):
+    # All model layers broadcast over leading dimensions, so rank-3 inputs are
+    # embedded directly with batched matrix multiplications.
     return embedder_fn(input_features, **kwargs)
-
-  sub_output_list, sub_activation_list = [], []
-  for sub_features in tf.unstack(input_features, axis=1):
-    sub_outputs, sub_activations = embedder_fn(sub_features, **kwargs)
-    sub_output_list.append(sub_outputs)
-    sub_activation_list.append(sub_activations)
-
-  outputs = {}
-  for key in sub_output_list[0].keys():
-    outputs[key] = tf.stack([sub_output[key] for sub_output in sub_output_list],
-                            axis=1)
-
-  activations = {}
-  for key in sub_activation_list[0].keys():
-    activations[key] = tf.stack(
-        [sub_activations[key] for sub_activations in sub_activation_list],
-        axis=1)
-
-  return outputs, activations
@@ -15,6 +15,7 @@
 
 """Tests model architecture functions."""
 
+import numpy as np
 import tensorflow.compat.v1 as tf
 
 from poem.core import common
@@ -124,6 +125,202 @@ class ModelsTest(tf.test.TestCase):
     self.assertAllClose(activations_result['base_activations'],
                         [[750.0, 750.0]])
 
+  def test_simple_model_forward_pass_with_activation_fn(self):
+    input_features = tf.constant([[-1.0, -2.0, -3.0]])
+    output_sizes = {'a': 1}
+    outputs, activations = models.simple_model(
+        input_features,
+        output_sizes,
+        is_training=True,
+        num_hidden_nodes=2,
+        weight_initializer=tf.initializers.ones(),
+        bias_initializer=tf.initializers.zeros(),
+        use_batch_norm=False,
+        num_fc_blocks=0,
+        activation_fn=tf.identity)
+
+    with self.session() as sess:
+      sess.run(tf.initializers.global_variables())
+      outputs_result, activations_result = sess.run([outputs, activations])
+
+    self.assertAllClose(outputs_result['a'], [[-12.0]])
+    self.assertAllClose(activations_result['base_activations'], [[-6.0, -6.0]])
+
+  def test_simple_model_forward_pass_with_xla_jit(self):
+    input_features = tf.constant([[1.0, 2.0, 3.0]])
+    output_sizes = {'a': 4}
+    outputs, activations = models.simple_model(
+        input_features,
+        output_sizes,
+        is_training=True,
+        num_hidden_nodes=2,
+        weight_initializer=tf.initializers.ones(),
+        bias_initializer=tf.initializers.zeros(),
+        weight_max_norm=0.0,
+        use_batch_norm=False,
+        dropout_rate=0.0,
+        num_fcs_per_block=2,
+        num_fc_blocks=3,
+        use_xla_jit=True)
+
+    # Only the model base is built in the XLA JIT scope.
+    base_ops, output_ops = [], []
+    for op in tf.get_default_graph().get_operations():
+      if op.name.startswith('SimpleModel/OutputLogits/'):
+        output_ops.append(op)
+      elif op.name.startswith('SimpleModel/'):
+        base_ops.append(op)
+    self.assertNotEmpty(base_ops)
+    self.assertNotEmpty(output_ops)
+    for op in base_ops:
+      self.assertTrue(op.get_attr('_XlaCompile'), msg=op.name)
+    for op in output_ops:
+      self.assertNotIn('_XlaCompile', op.node_def.attr, msg=op.name)
+
+    with self.session() as sess:
+      sess.run(tf.initializers.global_variables())
+      outputs_result, activations_result = sess.run([outputs, activations])
+
+    self.assertAllClose(outputs_result['a'], [[1500.0, 1500.0, 1500.0, 1500.0]])
+    self.assertAllClose(activations_result['base_activations'],
+                        [[750.0, 750.0]])
+
+  def test_simple_model_forward_pass_with_bfloat16_compute(self):
+    input_features = tf.constant([[1.0, 2.0, 3.0]])
+    output_sizes = {'a': 4}
+    outputs, activations = models.simple_model(
+        input_features,
+        output_sizes,
+        is_training=True,
+        num_hidden_nodes=2,
+        weight_initializer=tf.initializers.ones(),
+        bias_initializer=tf.initializers.zeros(),
+        weight_max_norm=0.0,
+        use_batch_norm=False,
+        dropout_rate=0.0,
+        num_fcs_per_block=2,
+        num_fc_blocks=3,
+        compute_dtype=tf.bfloat16)
+
+    self.assertEqual(outputs['a'].dtype, tf.float32)
+    self.assertEqual(activations['base_activations'].dtype, tf.float32)
+    with self.session() as sess:
+      sess.run(tf.initializers.global_variables())
+      outputs_result, activations_result = sess.run([outputs, activations])
+
+    self.assertAllClose(outputs_result['a'], [[1500.0, 1500.0, 1500.0, 1500.0]])
+    self.assertAllClose(activations_result['base_activations'],
+                        [[750.0, 750.0]])
+
+  def test_simple_model_clips_weights(self):
+    input_features = tf.constant([[1.0, 2.0, 3.0]])
+    output_sizes = {'a': 4}
+    outputs, _ = models.simple_model(
+        input_features,
+        output_sizes,
+        is_training=True,
+        num_hidden_nodes=8,
+        weight_max_norm=0.5,
+        num_fc_blocks=1)
+    train_op = tf.train.GradientDescentOptimizer(1.0).minimize(
+        tf.math.reduce_sum(outputs['a']))
+    weights = [
+        var for var in tf.global_variables() if var.op.name.endswith('/weight')
+    ]
+
+    with self.session() as sess:
+      sess.run(tf.initializers.global_variables())
+      initial_weights_result = sess.run(weights)
+      sess.run(train_op)
+      weights_result = sess.run(weights)
+
+    for weight in initial_weights_result + weights_result:
+      self.assertLessEqual(np.linalg.norm(weight), 0.5 + 1e-6)
+
+  def test_simple_model_inference_folds_batch_norm(self):
+    input_features = tf.constant([[1.0, 2.0, 3.0], [-4.0, 5.0, -6.0]])
+    output_sizes = {'a': 4}
+    models.simple_model(
+        input_features,
+        output_sizes,
+        is_training=True,
+        num_hidden_nodes=2,
+        num_fc_blocks=0)
+    num_training_variables = len(tf.global_variables())
+    outputs, activations = models.simple_model(
+        input_features,
+        output_sizes,
+        is_training=False,
+        num_hidden_nodes=2,
+        num_fc_blocks=0)
+    self.assertLen(tf.global_variables(), num_training_variables)
+
+    variables = {var.op.name: var for var in tf.global_variables()}
+    batch_norm_values = {
+        'SimpleModel/InputFC/BatchNorm/gamma': [2.0, 0.5],
+        'SimpleModel/InputFC/BatchNorm/beta': [0.1, -0.2],
+        'SimpleModel/InputFC/BatchNorm/moving_mean': [0.3, -0.4],
+        'SimpleModel/InputFC/BatchNorm/moving_variance': [1.5, 0.25],
+    }
+
+    with self.session() as sess:
+      sess.run(tf.initializers.global_variables())
+      sess.run([
+          variables[name].assign(value)
+          for name, value in batch_norm_values.items()
+      ])
+      outputs_result, activations_result, variables_result = sess.run(
+          [outputs, activations, variables])
+
+    net = (
+        np.matmul([[1.0, 2.0, 3.0], [-4.0, 5.0, -6.0]],
+                  variables_result['SimpleModel/InputFC/Linear/weight']) +
+        variables_result['SimpleModel/InputFC/Linear/bias'])
+    gamma, beta, moving_mean, moving_variance = [
+        np.array(value) for value in batch_norm_values.values()
+    ]
+    net = (net - moving_mean) / np.sqrt(moving_variance + 1e-3) * gamma + beta
+    net = np.maximum(net, 0.0)
+    self.assertAllClose(activations_result['base_activations'], net)
+    self.assertAllClose(
+        outputs_result['a'],
+        np.matmul(net, variables_result['SimpleModel/OutputLogits/a/weight']) +
+        variables_result['SimpleModel/OutputLogits/a/bias'])
+
+  def test_simple_model_updates_batch_norm_moving_statistics(self):
+    input_features = np.array(
+        [[1.0, 2.0, 3.0], [-4.0, 5.0, -6.0], [7.0, -8.0, 9.0],
+         [10.0, 11.0, -12.0]],
+        dtype=np.float32)
+    models.simple_model(
+        tf.constant(input_features), {'a': 4},
+        is_training=True,
+        num_hidden_nodes=2,
+        num_fc_blocks=0)
+
+    variables = {var.op.name: var for var in tf.global_variables()}
+    with self.session() as sess:
+      sess.run(tf.initializers.global_variables())
+      sess.run(tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+      variables_result = sess.run(variables)
+
+    net = (
+        np.matmul(input_features,
+                  variables_result['SimpleModel/InputFC/Linear/weight']) +
+        variables_result['SimpleModel/InputFC/Linear/bias'])
+    # Fused batch normalization updates moving variance with the unbiased batch
+    # variance.
+    self.assertAllClose(
+        variables_result['SimpleModel/InputFC/BatchNorm/moving_mean'],
+        0.01 * np.mean(net, axis=0),
+        rtol=1e-4,
+        atol=1e-4)
+    self.assertAllClose(
+        variables_result['SimpleModel/InputFC/BatchNorm/moving_variance'],
+        0.99 + 0.01 * np.var(net, axis=0, ddof=1),
+        rtol=1e-4,
+        atol=1e-4)
+
   def test_simple_gaussian_embedder(self):
     # Shape = [4, 2, 3].
     input_features = tf.constant([[[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]],
@@ -165,6 +362,18 @@ class ModelsTest(tf.test.TestCase):
         embedding_size=16)(
             input_features, is_training=True)
 
+    output_variable_shapes = {
+        var.name: var.shape.as_list()
+        for var in tf.global_variables()
+        if var.name.startswith('SimpleModel/OutputLogits/')
+    }
+    self.assertDictEqual(
+        output_variable_shapes, {
+            'SimpleModel/OutputLogits/unnormalized_embeddings/weight:0': [
+                1024, 48
+            ],
+            'SimpleModel/OutputLogits/unnormalized_embeddings/bias:0': [48],
+        })
     self.assertCountEqual(outputs.keys(), [common.KEY_EMBEDDING_MEANS])
     self.assertAllEqual(outputs[common.KEY_EMBEDDING_MEANS].shape.as_list(),
                         [4, 2, 3, 16])
@@ -184,6 +393,18 @@ class ModelsTest(tf.test.TestCase):
         embedding_size=16)(
             input_features, num_embedding_samples=32, is_training=False)
 
+    output_variable_shapes = {
+        var.name: var.shape.as_list()
+        for var in tf.global_variables()
+        if var.name.startswith('SimpleModel/OutputLogits/')
+    }
+    self.assertDictEqual(
+        output_variable_shapes, {
+            'SimpleModel/OutputLogits/gaussian_parameters/weight:0': [
+                1024, 96
+            ],
+            'SimpleModel/OutputLogits/gaussian_parameters/bias:0': [96],
+        })
     self.assertCountEqual(outputs.keys(), [
         common.KEY_EMBEDDING_MEANS,
         common.KEY_EMBEDDING_STDDEVS,
@@ -199,6 +420,135 @@ class ModelsTest(tf.test.TestCase):
     self.assertAllEqual(activations['base_activations'].shape.as_list(),
                         [4, 2, 1024])
 
+  def test_enable_xla_autoclustering(self):
+    session_config = models.enable_xla_autoclustering(
+        tf.ConfigProto(allow_soft_placement=True))
+
+    self.assertTrue(session_config.allow_soft_placement)
+    self.assertEqual(
+        session_config.graph_options.optimizer_options.global_jit_level,
+        tf.OptimizerOptions.ON_2)
+
+  def test_embed_rank_3_input(self):
+    # Shape = [4, 2, 3].
+    input_features = tf.constant([[[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]],
+                                  [[7.0, 8.0, 9.0], [10.0, 11.0, 12.0]],
+                                  [[13.0, 14.0, 15.0], [16.0, 17.0, 18.0]],
+                                  [[19.0, 20.0, 21.0], [22.0, 23.0, 24.0]]])
+    outputs, activations = models.embed(
+        input_features,
+        embedding_type=common.EMBEDDING_TYPE_POINT,
+        num_embedding_components=3,
+        embedding_size=16,
+        is_training=False)
+    instance_outputs, instance_activations = zip(*[
+        models.embed(
+            x,
+            embedding_type=common.EMBEDDING_TYPE_POINT,
+            num_embedding_components=3,
+            embedding_size=16,
+            is_training=False) for x in tf.unstack(input_features, axis=1)
+    ])
+
+    self.assertAllEqual(outputs[common.KEY_EMBEDDING_MEANS].shape.as_list(),
+                        [4, 2, 3, 16])
+    self.assertAllEqual(activations['base_activations'].shape.as_list(),
+                        [4, 2, 1024])
+
+    with self.session() as sess:
+      sess.run(tf.initializers.global_variables())
+      (outputs_result, activations_result, instance_outputs_result,
+       instance_activations_result) = sess.run(
+           [outputs, activations, instance_outputs, instance_activations])
+
+    # Batched and per-instance matrix multiplications may accumulate in
+    # different orders.
+    for i in range(2):
+      self.assertAllClose(
+          outputs_result[common.KEY_EMBEDDING_MEANS][:, i],
+          instance_outputs_result[i][common.KEY_EMBEDDING_MEANS],
+          rtol=1e-4,
+          atol=1e-3)
+      self.assertAllClose(
+          activations_result['base_activations'][:, i],
+          instance_activations_result[i]['base_activations'],
+          rtol=1e-4,
+          atol=1e-3)
+
+  def test_embed_rank_3_input_in_training(self):
+    input_features = np.array(
+        [[[1.0, 2.0, 3.0], [4.0, -5.0, 6.0]], [[-7.0, 8.0, 9.0],
+                                               [10.0, 11.0, -12.0]]],
+        dtype=np.float32)
+    _, activations = models.embed(
+        tf.constant(input_features),
+        embedding_type=common.EMBEDDING_TYPE_POINT,
+        num_embedding_components=1,
+        embedding_size=2,
+        is_training=True,
+        num_hidden_nodes=4,
+        num_fc_blocks=0,
+        activation_fn=tf.identity)
+
+    # Batch norm statistics are updated once per step for all instances.
+    update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+    self.assertLen(update_ops, 2)
+
+    variables = {var.op.name: var for var in tf.global_variables()}
+    with self.session() as sess:
+      sess.run(tf.initializers.global_variables())
+      activations_result, _ = sess.run([activations, update_ops])
+      variables_result = sess.run(variables)
+
+    # Batch norm statistics are pooled over the batch and instance dimensions.
+    net = (
+        np.matmul(input_features,
+                  variables_result['SimpleModel/InputFC/Linear/weight']) +
+        variables_result['SimpleModel/InputFC/Linear/bias'])
+    mean = np.mean(net, axis=(0, 1))
+    variance = np.var(net, axis=(0, 1))
+    self.assertAllClose(
+        activations_result['base_activations'],
+        (net - mean) / np.sqrt(variance + 1e-3),
+        rtol=1e-4,
+        atol=1e-4)
+    self.assertAllClose(
+        variables_result['SimpleModel/InputFC/BatchNorm/moving_mean'],
+        0.01 * mean,
+        rtol=1e-4,
+        atol=1e-4)
+
+  def test_embed_with_xla_jit(self):
+    # Shape = [4, 2, 3].
+    input_features = tf.constant([[[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]],
+                                  [[7.0, 8.0, 9.0], [10.0, 11.0, 12.0]],
+                                  [[13.0, 14.0, 15.0], [16.0, 17.0, 18.0]],
+                                  [[19.0, 20.0, 21.0], [22.0, 23.0, 24.0]]])
+    outputs, _ = models.embed(
+        input_features,
+        embedding_type=common.EMBEDDING_TYPE_GAUSSIAN,
+        num_embedding_components=3,
+        embedding_size=16,
+        num_embedding_samples=32,
+        is_training=True,
+        use_xla_jit=True)
+
+    # Every op except the input is built in the XLA JIT scope.
+    for op in tf.get_default_graph().get_operations():
+      if op is not input_features.op:
+        self.assertTrue(op.get_attr('_XlaCompile'), msg=op.name)
+
+    with self.session() as sess:
+      sess.run(tf.initializers.global_variables())
+      outputs_result = sess.run(outputs)
+
+    self.assertAllEqual(outputs_result[common.KEY_EMBEDDING_MEANS].shape,
+                        [4, 2, 3, 16])
+    self.assertAllEqual(outputs_result[common.KEY_EMBEDDING_STDDEVS].shape,
+                        [4, 2, 3, 16])
+    self.assertAllEqual(outputs_result[common.KEY_EMBEDDING_SAMPLES].shape,
+                        [4, 2, 3, 32, 16])
+
 
 if __name__ == '__main__':
   tf.test.main()
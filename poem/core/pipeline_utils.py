@@ -15,16 +15,20 @@
 
 """Pipeline utility functions."""
 
+import collections
 import json
 import os
+import re
 import sys
 
 from absl import logging
+import numpy as np
 import tensorflow.compat.v1 as tf
 import tf_slim
 
 from poem.core import common
 from poem.core import keypoint_utils
+from poem.core import models
 from poem.core import tfe_input_layer
 
 
@@ -265,6 +269,86 @@ def get_moving_average_variables_to_restore(global_step=None):
   return variables_to_restore
 
 
+# Matches variables of legacy embedder output layers built per component, e.g.,
+# `SimpleModel/OutputLogits/C0/unnormalized_embeddings/weight`, or built
+# separately for Gaussian embedding standard deviations, e.g.,
+# `SimpleModel/OutputLogits/embedding_stddevs/weight`.
+_LEGACY_EMBEDDER_VARIABLE_NAME_REGEX = re.compile(
+    r'/OutputLogits/(C\d+|%s)/' % common.KEY_EMBEDDING_STDDEVS)
+
+
+def convert_legacy_embedder_checkpoint(input_checkpoint, output_checkpoint):
+  """Converts a checkpoint with legacy embedder output layers.
+
+  Legacy embedders built one output layer per embedding component, with
+  variables named `${PREFIX}/OutputLogits/C${c}/${KEY}/${VARIABLE}${SUFFIX}`,
+  e.g., `SimpleModel/OutputLogits/C0/unnormalized_embeddings/weight/Adagrad`.
+  Embedders now build one output layer for all components, whose outputs are
+  reshaped to [..., num_embedding_components, embedding_size]. The converted
+  variables are therefore the per-component variables concatenated along the
+  last (output) dimension in component order, named
+  `${PREFIX}/OutputLogits/${KEY}/${VARIABLE}${SUFFIX}`.
+
+  Legacy Gaussian embedders also built separate output layers for embedding
+  means and standard deviations. Gaussian embedders now build one output layer
+  named `gaussian_parameters`, whose outputs are reshaped to [..., 2,
+  num_embedding_components, embedding_size] with means first. The converted
+  variables are therefore the means and standard deviation variables
+  concatenated along the last dimension, in this order.
+
+  Other variables are copied unchanged.
+
+  Args:
+    input_checkpoint: A string for the path to the checkpoint to convert.
+    output_checkpoint: A string for the path prefix of the converted checkpoint
+      to write.
+
+  Returns:
+    A string for the path to the converted checkpoint.
+  """
+  reader = tf.train.load_checkpoint(input_checkpoint)
+  values = {
+      name: reader.get_tensor(name)
+      for name in reader.get_variable_to_shape_map()
+  }
+
+  component_values = collections.defaultdict(dict)
+  for name in list(values.keys()):
+    match = re.match(r'^(.*/OutputLogits/)C(\d+)/(.*)$', name)
+    if match:
+      prefix, component, suffix = match.groups()
+      component_values[prefix + suffix][int(component)] = values.pop(name)
+  for name, values_by_component in component_values.items():
+    values[name] = np.concatenate(
+        [values_by_component[c] for c in sorted(values_by_component)],
+        axis=-1)
+
+  for name in list(values.keys()):
+    match = re.match(
+        r'^(.*/OutputLogits/)%s/(.*)$' % common.KEY_EMBEDDING_STDDEVS, name)
+    if match:
+      prefix, suffix = match.groups()
+      means_name = prefix + common.KEY_EMBEDDING_MEANS + '/' + suffix
+      values[prefix + 'gaussian_parameters/' + suffix] = np.concatenate(
+          [values.pop(means_name), values.pop(name)], axis=-1)
+
+  with tf.Graph().as_default():
+    placeholders, variables = {}, {}
+    for i, (name, value) in enumerate(sorted(values.items())):
+      placeholders[name] = tf.placeholder(
+          tf.as_dtype(value.dtype), shape=value.shape)
+      variables[name] = tf.Variable(placeholders[name], name='Variable_%d' % i)
+
+    with tf.Session() as sess:
+      sess.run(
+          tf.initializers.variables(list(variables.values())),
+          feed_dict={
+              placeholders[name]: value for name, value in values.items()
+          })
+      return tf.train.Saver(variables).save(
+          sess, output_checkpoint, write_meta_graph=False)
+
+
 def get_init_fn(train_dir=None,
                 model_checkpoint=None,
                 exclude_list=None,
@@ -296,6 +380,10 @@ def get_init_fn(train_dir=None,
   Returns:
     An model initializer function if an existing checkpoint is found. None
       otherwise.
+
+  Raises:
+    ValueError: If the checkpoint has legacy embedder output layer variables.
+      See `convert_legacy_embedder_checkpoint`.
   """
   # Make sure the exclude list is a list.
   if not exclude_list:
@@ -321,6 +409,15 @@ def get_init_fn(train_dir=None,
     logging.info('Do not initialize from a checkpoint.')
     return None
 
+  # Missing variables are ignored when restoring, so fail explicitly instead of
+  # silently reinitializing renamed embedder output layers.
+  for variable_name, _ in tf.train.list_variables(model_checkpoint):
+    if _LEGACY_EMBEDDER_VARIABLE_NAME_REGEX.search(variable_name):
+      raise ValueError(
+          'Checkpoint has legacy embedder output layer variable `%s`. Convert '
+          'it with `convert_legacy_embedder_checkpoint` first: `%s`.' %
+          (variable_name, model_checkpoint))
+
   variables_to_restore = tf_slim.get_variables_to_restore(
       include=include_list, exclude=exclude_list)
 
@@ -330,6 +427,87 @@ def get_init_fn(train_dir=None,
       ignore_missing_vars=ignore_missing_vars)
 
 
+def export_embedder_saved_model(export_dir,
+                                model_checkpoint,
+                                input_feature_dim,
+                                embedding_type,
+                                num_embedding_components,
+                                embedding_size,
+                                batch_size=1,
+                                use_moving_average=True,
+                                **kwargs):
+  """Exports an inference embedder with fixed input shape as a SavedModel.
+
+  The exported model has a single `serving_default` signature with input
+  `input_features` and the embedder outputs. Since all shapes are fixed, it can
+  be ahead-of-time compiled into a library without the TensorFlow runtime, for
+  example:
+    saved_model_cli aot_compile_cpu \
+      --dir=${EXPORT_DIR} \
+      --tag_set=serve \
+      --signature_def_key=serving_default \
+      --output_prefix=${OUTPUT_DIR}/embedder \
+      --cpp_class=Embedder
+
+  Args:
+    export_dir: A string for the SavedModel directory to create.
+    model_checkpoint: A string as the path to the model checkpoint to export.
+    input_feature_dim: An integer for input feature dimensionality.
+    embedding_type: An enum string for embedding type. See supported embedding
+      types in the `common` module.
+    num_embedding_components: An integer for the number of embedding components.
+    embedding_size: An integer for embedding dimensionality.
+    batch_size: An integer for the fixed inference batch size.
+    use_moving_average: A boolean for whether to export the exponential moving
+      averages of the variables.
+    **kwargs: A dictionary for additional arguments for embedder. Must match
+      the arguments used in training. Gaussian embedders also require
+      `num_embedding_samples`, which should be 0 for ahead-of-time compilation
+      since sampling uses stateful random ops. Constrained variables (e.g.,
+      weights with `weight_max_norm`) are exported with their constraints
+      applied.
+  """
+  with tf.Graph().as_default():
+    input_features = tf.placeholder(
+        tf.float32,
+        shape=[batch_size, input_feature_dim],
+        name='input_features')
+    outputs, _ = models.embed(
+        input_features,
+        embedding_type=embedding_type,
+        num_embedding_components=num_embedding_components,
+        embedding_size=embedding_size,
+        is_training=False,
+        **kwargs)
+
+    if use_moving_average:
+      saver = tf.train.Saver(get_moving_average_variables_to_restore())
+    else:
+      saver = tf.train.Saver()
+
+    # Checkpoints may store variables violating their constraints, e.g., if
+    # trained when weights were clipped on read.
+    constrain_ops = [
+        var.assign(var.constraint(var))
+        for var in tf.global_variables()
+        if var.constraint is not None
+    ]
+
+    with tf.Session() as sess:
+      saver.restore(sess, model_checkpoint)
+      sess.run(constrain_ops)
+      builder = tf.saved_model.Builder(export_dir)
+      builder.add_meta_graph_and_variables(
+          sess, [tf.saved_model.SERVING],
+          signature_def_map={
+              tf.saved_model.DEFAULT_SERVING_SIGNATURE_DEF_KEY:
+                  tf.saved_model.predict_signature_def(
+                      inputs={'input_features': input_features},
+                      outputs=outputs)
+          })
+      builder.save()
+
+
 def add_summary(scalars_to_summarize=None,
                 histograms_to_summarize=None,
                 images_to_summarize=None):
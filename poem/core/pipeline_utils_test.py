@@ -18,8 +18,10 @@
 import os
 
 from absl import flags
+import numpy as np
 import tensorflow.compat.v1 as tf
 
+from poem.core import common
 from poem.core import keypoint_profiles
 from poem.core import models
 from poem.core import pipeline_utils
@@ -28,6 +30,18 @@ tf.disable_v2_behavior()
 FLAGS = flags.FLAGS
 
 
+def _save_checkpoint(values, checkpoint_path):
+  """Saves a checkpoint with variables of given names and values."""
+  with tf.Graph().as_default():
+    variables = {
+        name: tf.Variable(value, name='Variable_%d' % i)
+        for i, (name, value) in enumerate(values.items())
+    }
+    with tf.Session() as sess:
+      sess.run(tf.initializers.global_variables())
+      return tf.train.Saver(variables).save(sess, checkpoint_path)
+
+
 class PipelineUtilsTest(tf.test.TestCase):
 
   def test_read_batch_from_tfe_tables(self):
@@ -143,6 +157,212 @@ class PipelineUtilsTest(tf.test.TestCase):
         {var.name: var.shape.as_list() for var in tf.global_variables()},
         expected_global_variable_shapes)
 
+  def test_convert_legacy_point_embedder_checkpoint(self):
+    weights = [
+        np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]], dtype=np.float32),
+        np.array([[7.0, 8.0, 9.0], [10.0, 11.0, 12.0]], dtype=np.float32),
+    ]
+    biases = [
+        np.array([0.1, 0.2, 0.3], dtype=np.float32),
+        np.array([0.4, 0.5, 0.6], dtype=np.float32),
+    ]
+    input_weight = np.array([[1.0, -1.0]], dtype=np.float32)
+    legacy_checkpoint = _save_checkpoint(
+        {
+            'M/InputFC/Linear/weight': input_weight,
+            'M/OutputLogits/C0/unnormalized_embeddings/weight': weights[0],
+            'M/OutputLogits/C1/unnormalized_embeddings/weight': weights[1],
+            'M/OutputLogits/C0/unnormalized_embeddings/bias': biases[0],
+            'M/OutputLogits/C1/unnormalized_embeddings/bias': biases[1],
+            'M/OutputLogits/C0/unnormalized_embeddings/weight/Adagrad':
+                weights[0] + 1.0,
+            'M/OutputLogits/C1/unnormalized_embeddings/weight/Adagrad':
+                weights[1] + 1.0,
+        }, os.path.join(self.get_temp_dir(), 'legacy.ckpt'))
+
+    converted_checkpoint = pipeline_utils.convert_legacy_embedder_checkpoint(
+        legacy_checkpoint, os.path.join(self.get_temp_dir(), 'converted.ckpt'))
+
+    reader = tf.train.load_checkpoint(converted_checkpoint)
+    self.assertCountEqual(
+        reader.get_variable_to_shape_map().keys(), [
+            'M/InputFC/Linear/weight',
+            'M/OutputLogits/unnormalized_embeddings/weight',
+            'M/OutputLogits/unnormalized_embeddings/bias',
+            'M/OutputLogits/unnormalized_embeddings/weight/Adagrad',
+        ])
+    self.assertAllEqual(
+        reader.get_tensor('M/InputFC/Linear/weight'), input_weight)
+    self.assertAllEqual(
+        reader.get_tensor('M/OutputLogits/unnormalized_embeddings/weight'),
+        [[1.0, 2.0, 3.0, 7.0, 8.0, 9.0], [4.0, 5.0, 6.0, 10.0, 11.0, 12.0]])
+    self.assertAllClose(
+        reader.get_tensor('M/OutputLogits/unnormalized_embeddings/bias'),
+        [0.1, 0.2, 0.3, 0.4, 0.5, 0.6])
+    self.assertAllEqual(
+        reader.get_tensor(
+            'M/OutputLogits/unnormalized_embeddings/weight/Adagrad'),
+        [[2.0, 3.0, 4.0, 8.0, 9.0, 10.0], [5.0, 6.0, 7.0, 11.0, 12.0, 13.0]])
+
+  def test_convert_legacy_gaussian_embedder_checkpoint(self):
+    means_weights = [
+        np.array([[1.0, 2.0]], dtype=np.float32),
+        np.array([[3.0, 4.0]], dtype=np.float32),
+    ]
+    stddevs_weights = [
+        np.array([[5.0, 6.0]], dtype=np.float32),
+        np.array([[7.0, 8.0]], dtype=np.float32),
+    ]
+    legacy_checkpoint = _save_checkpoint(
+        {
+            'M/OutputLogits/C0/unnormalized_embeddings/weight':
+                means_weights[0],
+            'M/OutputLogits/C1/unnormalized_embeddings/weight':
+                means_weights[1],
+            'M/OutputLogits/C0/embedding_stddevs/weight': stddevs_weights[0],
+            'M/OutputLogits/C1/embedding_stddevs/weight': stddevs_weights[1],
+        }, os.path.join(self.get_temp_dir(), 'legacy.ckpt'))
+
+    converted_checkpoint = pipeline_utils.convert_legacy_embedder_checkpoint(
+        legacy_checkpoint, os.path.join(self.get_temp_dir(), 'converted.ckpt'))
+
+    reader = tf.train.load_checkpoint(converted_checkpoint)
+    self.assertCountEqual(reader.get_variable_to_shape_map().keys(),
+                          ['M/OutputLogits/gaussian_parameters/weight'])
+    # Reshaped to [2, num_embedding_components, embedding_size], means come
+    # first and components are in order.
+    self.assertAllEqual(
+        np.reshape(
+            reader.get_tensor('M/OutputLogits/gaussian_parameters/weight'),
+            [2, 2, 2]),
+        [[[1.0, 2.0], [3.0, 4.0]], [[5.0, 6.0], [7.0, 8.0]]])
+
+  def test_convert_separate_gaussian_embedder_checkpoint(self):
+    legacy_checkpoint = _save_checkpoint(
+        {
+            'M/OutputLogits/unnormalized_embeddings/bias':
+                np.array([1.0, 2.0, 3.0, 4.0], dtype=np.float32),
+            'M/OutputLogits/embedding_stddevs/bias':
+                np.array([5.0, 6.0, 7.0, 8.0], dtype=np.float32),
+        }, os.path.join(self.get_temp_dir(), 'legacy.ckpt'))
+
+    converted_checkpoint = pipeline_utils.convert_legacy_embedder_checkpoint(
+        legacy_checkpoint, os.path.join(self.get_temp_dir(), 'converted.ckpt'))
+
+    reader = tf.train.load_checkpoint(converted_checkpoint)
+    self.assertCountEqual(reader.get_variable_to_shape_map().keys(),
+                          ['M/OutputLogits/gaussian_parameters/bias'])
+    self.assertAllEqual(
+        reader.get_tensor('M/OutputLogits/gaussian_parameters/bias'),
+        [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0])
+
+  def test_get_init_fn_with_separate_gaussian_embedder_checkpoint(self):
+    legacy_checkpoint = _save_checkpoint(
+        {
+            'M/OutputLogits/embedding_stddevs/weight':
+                np.zeros([2, 3], dtype=np.float32),
+        }, os.path.join(self.get_temp_dir(), 'legacy.ckpt'))
+
+    with self.assertRaisesRegex(ValueError, 'legacy embedder output layer'):
+      pipeline_utils.get_init_fn(model_checkpoint=legacy_checkpoint)
+
+  def test_get_init_fn_with_legacy_embedder_checkpoint(self):
+    legacy_checkpoint = _save_checkpoint(
+        {
+            'M/OutputLogits/C0/unnormalized_embeddings/weight':
+                np.zeros([2, 3], dtype=np.float32),
+        }, os.path.join(self.get_temp_dir(), 'legacy.ckpt'))
+
+    with self.assertRaisesRegex(ValueError, 'legacy embedder output layer'):
+      pipeline_utils.get_init_fn(model_checkpoint=legacy_checkpoint)
+
+  def test_export_embedder_saved_model(self):
+    model_dir = self.get_temp_dir()
+    with tf.Graph().as_default():
+      outputs, _ = models.embed(
+          tf.constant([[1.0, -2.0, 3.0]]),
+          embedding_type=common.EMBEDDING_TYPE_POINT,
+          num_embedding_components=2,
+          embedding_size=4,
+          is_training=False)
+      with self.session() as sess:
+        sess.run(tf.initializers.global_variables())
+        expected_embeddings = sess.run(outputs[common.KEY_EMBEDDING_MEANS])
+        model_checkpoint = tf.train.Saver().save(
+            sess, os.path.join(model_dir, 'model.ckpt'))
+
+    export_dir = os.path.join(model_dir, 'export')
+    pipeline_utils.export_embedder_saved_model(
+        export_dir,
+        model_checkpoint,
+        input_feature_dim=3,
+        embedding_type=common.EMBEDDING_TYPE_POINT,
+        num_embedding_components=2,
+        embedding_size=4,
+        use_moving_average=False)
+
+    with tf.Graph().as_default():
+      with self.session() as sess:
+        meta_graph_def = tf.saved_model.load(sess, [tf.saved_model.SERVING],
+                                             export_dir)
+        signature = meta_graph_def.signature_def[
+            tf.saved_model.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+        input_shape = signature.inputs['input_features'].tensor_shape
+        self.assertAllEqual([d.size for d in input_shape.dim], [1, 3])
+        embeddings = sess.run(
+            signature.outputs[common.KEY_EMBEDDING_MEANS].name,
+            feed_dict={
+                signature.inputs['input_features'].name: [[1.0, -2.0, 3.0]]
+            })
+
+    self.assertAllClose(embeddings, expected_embeddings)
+
+  def test_export_embedder_saved_model_clips_weights(self):
+    model_dir = self.get_temp_dir()
+    with tf.Graph().as_default():
+      models.embed(
+          tf.zeros([1, 3]),
+          embedding_type=common.EMBEDDING_TYPE_POINT,
+          num_embedding_components=2,
+          embedding_size=4,
+          is_training=False,
+          num_hidden_nodes=8,
+          num_fc_blocks=0)
+      with self.session() as sess:
+        sess.run(tf.initializers.global_variables())
+        sess.run([
+            var.assign(tf.ones_like(var))
+            for var in tf.global_variables()
+            if var.op.name.endswith('/weight')
+        ])
+        model_checkpoint = tf.train.Saver().save(
+            sess, os.path.join(model_dir, 'model.ckpt'))
+
+    export_dir = os.path.join(model_dir, 'export')
+    pipeline_utils.export_embedder_saved_model(
+        export_dir,
+        model_checkpoint,
+        input_feature_dim=3,
+        embedding_type=common.EMBEDDING_TYPE_POINT,
+        num_embedding_components=2,
+        embedding_size=4,
+        use_moving_average=False,
+        num_hidden_nodes=8,
+        num_fc_blocks=0,
+        weight_max_norm=0.5)
+
+    with tf.Graph().as_default():
+      with self.session() as sess:
+        tf.saved_model.load(sess, [tf.saved_model.SERVING], export_dir)
+        weights_result = sess.run([
+            var for var in tf.global_variables()
+            if var.op.name.endswith('/weight')
+        ])
+
+    self.assertLen(weights_result, 2)
+    for weight in weights_result:
+      self.assertAllClose(np.linalg.norm(weight), 0.5)
+
   def test_get_moving_average_variables_to_restore(self):
     inputs = tf.zeros([4, 2, 3])
     output_sizes = {'a': 8, 'b': 4}
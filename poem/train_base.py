@@ -228,6 +228,11 @@ flags.DEFINE_list(
 flags.DEFINE_bool('profile_only', False,
                   'Whether to profile the training graph and exit.')
 
+flags.DEFINE_bool(
+    'use_xla_autoclustering', False,
+    'Whether to enable XLA auto-clustering in the training session. Works best '
+    'with fixed input shapes.')
+
 flags.DEFINE_integer('startup_delay_steps', 15, 'Startup step delay.')
 
 flags.DEFINE_integer(
@@ -669,6 +674,11 @@ def run(master, input_dataset_class, common_module, keypoint_profiles_module,
         pipeline_utils.profile()
         return
 
+      session_config = tf.ConfigProto(
+          allow_soft_placement=True, log_device_placement=False)
+      if FLAGS.use_xla_autoclustering:
+        session_config = models.enable_xla_autoclustering(session_config)
+
       tf_slim.learning.train(
           train_op,
           logdir=FLAGS.train_log_dir,
@@ -681,5 +691,4 @@ def run(master, input_dataset_class, common_module, keypoint_profiles_module,
           startup_delay_steps=FLAGS.startup_delay_steps * FLAGS.task,
           saver=saver,
           save_interval_secs=FLAGS.save_interval_secs,
-          session_config=tf.ConfigProto(
-              allow_soft_placement=True, log_device_placement=False))
+          session_config=session_config)